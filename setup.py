@@ -10,4 +10,7 @@ setup(name='tiling',
       install_requires=[
           'numpy','Pillow'
       ],
+      extras_require={
+          'pyvips':['pyvips']
+      },
       zip_safe=False)
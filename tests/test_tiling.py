@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from tiling import Tiling
+
+def make_image(mode, h=70, w=90, seed=0):
+    rng = np.random.default_rng(seed)
+    if mode == 'F':
+        return Image.fromarray((rng.random((h, w))*255).astype(np.float32))
+    if mode == 'I;16':
+        return Image.fromarray(rng.integers(0, 300, (h, w), dtype=np.uint16))
+    img = Image.fromarray(rng.integers(0, 256, (h, w, 3), dtype=np.uint8))
+    if mode == 'P':
+        return img.quantize(16)
+    return img.convert(mode)
+
+def tile_means(img, t):
+    arr = np.asarray(img).astype(np.float64)
+    return np.array([arr[top:bottom, left:right].mean() for (left, top, right, bottom) in t.get_tile_rects()])
+
+@pytest.mark.parametrize('mode', ['1', 'L', 'P', 'RGB', 'RGBA', 'I', 'F', 'I;16'])
+@pytest.mark.parametrize('size, stride', [(16, 16),   # disjoint
+                                          (16, 23),   # gaps between tiles
+                                          (16, 5),    # overlap
+                                          (10, 7),    # overlap, sizes not divisible
+                                          (20, 1)])
+def test_filter_tiles_mask(mode, size, stride):
+    img = make_image(mode)
+    t = Tiling(size, stride)
+    t.apply(img)
+    means = tile_means(img, t)
+    (lower, upper) = (np.percentile(means, 25), np.percentile(means, 75))
+    mask = t.filter_tiles_mask(lower, upper)
+    assert mask.shape == (t.n_tiles,)
+    assert np.array_equal(mask, (means > lower) & (means < upper))
+
+def test_filter_tiles_mask_no_tiles():
+    t = Tiling(100)
+    t.apply(make_image('RGB', 50, 50))
+    assert t.filter_tiles_mask(0, 255).shape == (0,)
+
+def test_filter_tiles():
+    img = make_image('RGB')
+    t = Tiling(16, 5)
+    t.apply(img)
+    mask = t.filter_tiles_mask(126, 129)
+    tiles = list(t.filter_tiles(126, 129))
+    rects = [rect for (rect, keep) in zip(t.get_tile_rects(), mask) if keep]
+    assert [rect for (rect, tile) in tiles] == rects
+    for (rect, tile) in tiles:
+        assert tile.tobytes() == img.crop(rect).tobytes()
+
+@pytest.mark.parametrize('mode', ['L', 'P', 'RGB', 'RGBA'])
+def test_write_tiles_assemble(tmp_path, mode):
+    img = make_image(mode, 64, 96)
+    t = Tiling(16)
+    t.apply(img)
+    t.write_tiles(str(tmp_path), rotate=True, flip=True, filename_prefix='img', workers=2)
+    assert len(os.listdir(tmp_path)) == 8*t.n_tiles
+    files = [os.path.join(tmp_path, f) for f in sorted(os.listdir(tmp_path))]
+    out = t.assemble(files, mode=img.mode)
+    assert out.tobytes() == img.tobytes()
+
+def test_write_tiles_copies(tmp_path):
+    img = make_image('RGB', 32, 32)
+    t = Tiling(16)
+    t.apply(img)
+    t.write_tiles(str(tmp_path), rotate=True, flip=True, filename_prefix='img', workers=1)
+    tile = img.crop((16, 0, 32, 16))
+    with Image.open(os.path.join(tmp_path, 'img_x_00016_y_00000_rot_90.png')) as copy:
+        assert copy.tobytes() == tile.transpose(Image.ROTATE_90).tobytes()
+    with Image.open(os.path.join(tmp_path, 'img_x_00016_y_00000_flip_hor.png')) as copy:
+        assert copy.tobytes() == tile.transpose(Image.FLIP_LEFT_RIGHT).tobytes()
+
+@pytest.mark.parametrize('workers', [1, 4])
+def test_write_tiles_dedupe(tmp_path, workers):
+    arr = np.full((64, 64, 3), 200, dtype=np.uint8)
+    arr[16:32, 16:32] = np.random.default_rng(0).integers(0, 256, (16, 16, 3))
+    arr[48:64, 48:64] = arr[16:32, 16:32]
+    img = Image.fromarray(arr)
+    t = Tiling(16)
+    t.apply(img)
+    t.write_tiles(str(tmp_path), rotate=True, filename_prefix='img', workers=workers, dedupe=True)
+    files = [os.path.join(tmp_path, f) for f in sorted(os.listdir(tmp_path))]
+    assert len(files) == 4*t.n_tiles
+    # one uniform tile and one random tile, each with 3 rotated copies
+    assert len({os.stat(f).st_ino for f in files}) == 8
+    out = t.assemble(files)
+    assert out.tobytes() == img.tobytes()
+
+@pytest.mark.parametrize('tile_format', ['png', 'jpg'])
+def test_sqlite_assemble(tmp_path, tile_format):
+    if tile_format == 'png':
+        img = make_image('RGB', 64, 96)
+    else:
+        (y, x) = np.mgrid[:64, :96]
+        img = Image.fromarray(np.dstack([x*2, y*3, x+y]).astype(np.uint8))
+    t = Tiling(16)
+    t.apply(img)
+    db_path = str(tmp_path/'tiles.db')
+    t.write_tiles_sqlite(db_path, workers=2, tile_format=tile_format)
+    tiles = list(t.read_tiles_sqlite(db_path))
+    assert sorted(rect for (rect, tile) in tiles) == sorted(t.get_tile_rects())
+    out = np.asarray(t.assemble(tiles)).astype(int)
+    if tile_format == 'png':
+        assert np.array_equal(out, np.asarray(img))
+    else:
+        assert np.abs(out - np.asarray(img)).mean() < 3
+
+def test_assemble_images():
+    img = make_image('RGB', 64, 96)
+    t = Tiling(16)
+    t.apply(img)
+    tiles = list(t.get_tile_images())
+    assert t.assemble(tiles).tobytes() == img.tobytes()
+    rects = t.get_tile_rects()
+    assert t.assemble(list(zip(rects, tiles))[::-1]).tobytes() == img.tobytes()
+
+def test_stream():
+    img = make_image('RGB')
+    t = Tiling(16, 5)
+    t.apply(img)
+    def bright(tile):
+        return tile.mean() > 127
+    tiles = list(t.stream(bright, prefetch=3))
+    expected = [rect for (rect, mean) in zip(t.get_tile_rects(), tile_means(img, t)) if mean > 127]
+    assert [rect for (rect, tile) in tiles] == expected
+    for (rect, tile) in tiles:
+        assert tile.tobytes() == img.crop(rect).tobytes()
+    sunk = []
+    assert t.stream(bright, lambda tile: tile[0, 0], lambda rect, tile: sunk.append((rect, tuple(tile)))) is None
+    assert sunk == [(rect, img.getpixel(rect[:2])) for rect in expected]
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-tile numeric kernels.
+"""
+
+def tile_mean_mask(sat, rects, area, lower_threshold, upper_threshold):
+    '''
+    Marking tiles with lower_threshold < mean pixel value < upper_threshold.
+
+    Parameters:
+
+        sat (2D int64 or float64 array): summed-area table sampled at tile borders, as returned by
+            Tiling._get_sat(): with ys and xs the sorted distinct tile border coordinates,
+            sat[i, j] is the sum of pixel values in rows ys[0]..ys[i]-1 and columns xs[0]..xs[j]-1.
+
+        rects ((n_tiles, 4) int array): (left, top, right, bottom) rows of indices into sat,
+            i.e. positions of the tile borders in xs and ys, not pixel coordinates.
+
+        area (int): number of values in a tile (size*size*channels).
+
+    Returns:
+
+        numpy boolean array of shape (n_tiles,)
+    '''
+    (l, t, r, b) = rects.T
+    means = (sat[b,r] - sat[t,r] - sat[b,l] + sat[t,l])/area
+    return (means > lower_threshold) & (means < upper_threshold)
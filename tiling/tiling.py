@@ -6,10 +6,28 @@ Created on Fri Aug 16 10:25:52 2019
 @author: robert
 """
 
+import functools
+import hashlib
+import io
+import itertools
 import os
+import re
+import shutil
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 from PIL import Image, ImageDraw
+from ._kernels import tile_mean_mask
 
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
+
+# PIL transpose constants, used for tile copies of modes that can't be rebuilt from numpy arrays
 rot_angles = {90:Image.ROTATE_90,
               180:Image.ROTATE_180,
               270:Image.ROTATE_270}
@@ -17,6 +35,157 @@ rot_angles = {90:Image.ROTATE_90,
 flip_modes = {'hor':Image.FLIP_LEFT_RIGHT,
               'vert':Image.FLIP_TOP_BOTTOM}
 
+# (filename suffix, flip left-right first, number of 90 degree counter-clockwise rotations) 
+# for rotated and flipped tile copies; a vertical flip is a horizontal flip rotated by 180 degrees
+_ROTS = (('_rot_90', False, 1),
+         ('_rot_180', False, 2),
+         ('_rot_270', False, 3))
+
+_FLIPS = (('_flip_vert', True, 2),
+          ('_flip_hor', True, 0))
+
+_FLIP_ROTS = (('_flip_hor_rot_90', True, 1),
+              ('_flip_hor_rot_270', True, 3))
+
+# "x_<left>_y_<top>" part of a tile filename, and "rot"/"flip" parts of its rotated/flipped copies
+_COORD_RE = re.compile(r'(?:^|_)x_(\d+)_y_(\d+)(?:_|$)')
+_COPY_RE = re.compile(r'(?:^|_)(?:rot|flip)(?:_|$)')
+
+# PIL modes read through pyvips, with their numbers of 8-bit bands
+_VIPS_MODES = {'L':1, 'RGB':3, 'RGBA':4}
+
+def _get_save_params(tile_format, compress_level, quality):
+    '''
+    Returning (file extension, PIL save parameters) for the tile format.
+    '''
+    if tile_format == 'png':
+        return '.png', {'format':'PNG', 'compress_level':compress_level, 'optimize':False}
+    elif tile_format in ('jpg', 'jpeg'):
+        return '.jpg', {'format':'JPEG', 'quality':quality}
+    else:
+        raise ValueError('tile_format is expected to be "png" or "jpg".')
+
+def _encode_image(img, save_params):
+    '''
+    Encoding an image in memory.
+    '''
+    buf = io.BytesIO()
+    img.save(buf, **save_params)
+    return buf.getbuffer()
+
+def _encode_tile(arr, source, palette, save_params, rect):
+    '''
+    Encoding the tile at rect of the source array, or of the source image if arr is None. 
+    Returns (left, top, encoded bytes).
+    '''
+    (left, top, right, bottom) = rect
+    if arr is None:
+        img = source.crop(rect)
+    else:
+        img = Image.fromarray(arr[top:bottom, left:right])
+        if palette is not None:
+            img.putpalette(palette)
+    return left, top, bytes(_encode_image(img, save_params))
+
+def _save_image(img, path, save_params):
+    '''
+    Encoding an image in memory and writing it to path with a single unbuffered write.
+    '''
+    data = _encode_image(img, save_params)
+    # a previous file at path may be hard-linked to other tiles: replace it rather than truncate it
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    fd = os.open(path, os.O_CREAT | os.O_WRONLY | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
+
+def _tile_key(tile):
+    '''
+    Returning a key equal for tiles with identical contents: 
+    the color of uniform tiles, the content hash of other tiles.
+    '''
+    if (tile == tile[0, 0]).all():
+        return ('uniform', tile[0, 0].tobytes())
+    return hashlib.blake2b(np.ascontiguousarray(tile).tobytes(), digest_size=16).digest()
+
+def _link_file(src, dst):
+    '''
+    Hard-linking dst to src, or copying src to dst where hard links are not supported.
+    '''
+    try:
+        os.unlink(dst)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def _get_variants(rotate, flip):
+    '''
+    Returning (filename suffix, flip, rotations) triples for a tile and the copies to write with it.
+    '''
+    return ((('', False, 0),) + (_ROTS if rotate else ()) + (_FLIPS if flip else ())
+            + (_FLIP_ROTS if rotate and flip else ()))
+
+def _write_tile(arr, source, palette, size, variants, ext, save_params, left, top, path):
+    '''
+    Writing the tile at (left, top) of the source array, or of the source image if arr is None, 
+    with its rotated and flipped copies, to path+ext.
+    '''
+    if arr is None:
+        crop = source.crop((left, top, left+size, top+size))
+    else:
+        tile = arr[top:top+size, left:left+size]
+    for suffix, flip, k in variants:
+        if arr is None:
+            copy = crop.transpose(flip_modes['hor']) if flip else crop
+            if k:
+                copy = copy.transpose(rot_angles[90*k])
+        else:
+            # numpy views of the tile, materialized only when encoded
+            copy = Image.fromarray(np.rot90(np.fliplr(tile) if flip else tile, k))
+            if palette is not None:
+                copy.putpalette(palette)
+        _save_image(copy, path+suffix+ext, save_params)
+
+def _process_tile(arr, filter_fn, transform_fn, rect):
+    '''
+    Applying stream() functions to the tile at rect of the source array. Returns None for rejected tiles.
+    '''
+    (left, top, right, bottom) = rect
+    tile = arr[top:bottom, left:right]
+    if filter_fn is not None and not filter_fn(tile):
+        return None
+    if transform_fn is not None:
+        tile = transform_fn(tile)
+    return tile
+
+def _load_tile(path, mode):
+    '''
+    Decoding a tile file into an image of the given mode.
+    '''
+    with Image.open(path) as img:
+        if img.mode != mode:
+            return img.convert(mode)
+        img.load()
+        return img
+
+def _paste(canvas, tile, left, top, mode):
+    '''
+    Pasting a tile (PIL image or future of an image) into the canvas image at (left, top).
+    '''
+    if isinstance(tile, Future):
+        tile = tile.result()
+    elif tile.mode != mode:
+        tile = tile.convert(mode)
+    canvas.paste(tile, (left, top))
+
 class Tiling():
     '''
     Tool for slicing an image into square tiles of specified size. Requires PIL.
@@ -37,9 +206,21 @@ class Tiling():
         
         get_tile_rects(): yields iterable of (left, top, right, bottom) tuples for every tile.
 
+        get_tile_rects_array(): returns (n_tiles, 4) array of (left, top, right, bottom) rows for every tile.
+
         get_tile_images(): yields iterable of tile images.
+
+        filter_tiles(lower_threshold, upper_threshold): yields (rect, image) tuples for tiles with mean pixel value in the given range.
+
+        filter_tiles_mask(lower_threshold, upper_threshold): returns boolean mask of tiles with mean pixel value in the given range.
+
+        stream(filter_fn, transform_fn, sink_fn, prefetch): filters and transforms tile arrays in a thread pool, passing them on in tile order.
         
         write_tiles(target_dir): writes tiles as separate images into target_dir (by default "tiles" subfolder in source image folder).
+
+        write_tiles_sqlite(db_path): writes tiles into a single SQLite database file.
+
+        read_tiles_sqlite(db_path): yields (rect, image) tuples of tiles stored in a SQLite database file.
         
     '''
     
@@ -62,6 +243,8 @@ class Tiling():
         Parameter:
             
             source (str or PIL Image): image to tile. Can be filename or PIL image object.
+                                       If source is a filename and pyvips is installed, get_tile_images() reads
+                                       only the tiles' regions from the file instead of decoding the whole image.
         '''
 
         if type(source) is str:
@@ -71,10 +254,86 @@ class Tiling():
             self.source = source
             self.source_name = ''
         (w, h) = self.source.size
+        self._arr = None
+        self._sat = None
+        self._vips = None
+        if type(source) is str and pyvips is not None:
+            try:
+                vips = pyvips.Image.new_from_file(source, access='random')
+            except pyvips.Error:
+                # formats PIL can read but libvips has no loader for (PCX, ICO, TGA...)
+                vips = None
+            if vips is not None and vips.format == 'uchar' and vips.bands == _VIPS_MODES.get(self.source.mode):
+                self._vips = vips
         self.shape = ((h - self.size)//self.stride + 1,
                       (w - self.size)//self.stride + 1)
         self.n_tiles = self.shape[0]*self.shape[1]
+        lefts = np.arange(self.shape[1], dtype=np.int32)*self.stride
+        tops = np.arange(self.shape[0], dtype=np.int32)*self.stride
+        (L, T) = np.meshgrid(lefts, tops)
+        self._rects = np.stack([L, T, L+self.size, T+self.size], axis=-1).reshape(-1, 4)
+        # shared with callers of get_tile_rects_array()
+        self._rects.flags.writeable = False
+        # the same rects as tuples of python ints, shared by every method iterating over tiles
+        self._rects_list = list(map(tuple, self._rects.tolist()))
+
+    def _get_arr(self):
+        '''
+        Returning the source as numpy array, decoded on first use.
+        '''
+        if self._arr is None:
+            self._arr = np.asarray(self.source)
+        return self._arr
+
+    def _get_sat(self):
+        '''
+        Returning the summed-area table of the source sampled at tile borders, built on first use,
+        and the tile rects as indices into it: with ys and xs the sorted distinct tile border coordinates,
+        _sat[i, j] is the sum of pixel values in rows ys[0]..ys[i]-1 and columns xs[0]..xs[j]-1.
+        '''
+        if self._sat is None:
+            arr = self._get_arr()
+            (h, w) = arr.shape[:2]
+            arr = arr.reshape(h, w, -1)
+            dtype = np.float64 if arr.dtype.kind == 'f' else np.int64
+            # sum channels with whole-plane adds, which vectorize far better than a reduction 
+            # over the short channel axis; sums of up to 257 8-bit channels fit in 16 bits
+            acc_dtype = np.uint16 if arr.dtype.itemsize == 1 and arr.shape[2] <= 257 else dtype
+            pix_sums = arr[:,:,0].astype(acc_dtype)
+            for c in range(1, arr.shape[2]):
+                pix_sums += arr[:,:,c]
+            # only sums between tile borders are needed: reduce the 16-bit plane into bands
+            # with row-vector adds, instead of building a full-size int64 table
+            lefts = np.arange(self.shape[1])*self.stride
+            tops = np.arange(self.shape[0])*self.stride
+            ys = np.union1d(tops, tops+self.size)
+            xs = np.union1d(lefts, lefts+self.size)
+            self._sat = np.zeros((len(ys), len(xs)), dtype=dtype)
+            if len(ys) > 1 and len(xs) > 1:
+                bands = np.add.reduceat(pix_sums[ys[0]:ys[-1]], ys[:-1]-ys[0], axis=0, dtype=dtype)
+                blocks = np.add.reduceat(bands[:,xs[0]:xs[-1]], xs[:-1]-xs[0], axis=1)
+                self._sat[1:,1:] = blocks.cumsum(0).cumsum(1)
+            (L, T) = np.meshgrid(np.searchsorted(xs, lefts), np.searchsorted(ys, tops))
+            (R, B) = np.meshgrid(np.searchsorted(xs, lefts+self.size), np.searchsorted(ys, tops+self.size))
+            self._sat_rects = np.stack([L, T, R, B], axis=-1).reshape(-1, 4)
+        return self._sat, self._sat_rects
             
+    def _get_tile_sums(self):
+        '''
+        Returning the sums of pixel values of non-overlapping tiles (stride >= size),
+        in the order of get_tile_rects(), reduced over a strided view of the source array.
+        '''
+        arr = self._get_arr()
+        (h, w) = arr.shape[:2]
+        arr = arr.reshape(h, w, -1)
+        (rows, cols) = (max(self.shape[0], 0), max(self.shape[1], 0))
+        (row_step, col_step, channel_step) = arr.strides
+        tiles = as_strided(arr, (rows, self.size, cols, self.size, arr.shape[2]),
+                           (self.stride*row_step, row_step, self.stride*col_step, col_step, channel_step),
+                           writeable=False)
+        dtype = np.float64 if arr.dtype.kind == 'f' else np.int64
+        return tiles.sum(axis=(1,3,4), dtype=dtype).ravel()
+
     def get_tile_rects(self):
         '''
         Yielding iterable of (left, top, right, bottom) tuples for every tile.
@@ -90,13 +349,24 @@ class Tiling():
         '''
         if self.source is None:
             raise AttributeError('You should apply the tiling to an image before calling this method.')
-        left, top = 0, 0
-        while top < self.source.size[1]:
-            while left < self.source.size[0]:
-                yield (left, top, left+self.size, top+self.size)
-                left += self.stride
-            left = 0
-            top += self.stride
+        yield from self._rects_list
+
+    def get_tile_rects_array(self):
+        '''
+        Returning (left, top, right, bottom) coordinates of all tiles at once, for vectorized processing.
+
+        Syntax:
+            
+            rects = t.get_tile_rects_array()
+            
+        Returns:
+            
+            read-only numpy int32 array of shape (n_tiles, 4), tiles ordered from left to right, from top to bottom.
+        
+        '''
+        if self.source is None:
+            raise AttributeError('You should apply the tiling to an image before calling this method.')
+        return self._rects
             
     def get_tile_images(self):
         '''
@@ -112,25 +382,38 @@ class Tiling():
         '''
         if self.source is None:
             raise AttributeError('You should apply the tiling to an image before calling this method.')
-        left, top = 0, 0
-        while top < self.source.size[1]:
-            while left < self.source.size[0]:
-                yield self.source.crop((left, top, 
-                                       left+self.size, top+self.size))
-                left += self.stride
-            left = 0
-            top += self.stride
+        if self._vips is not None:
+            mode = self.source.mode
+            for (left, top, right, bottom) in self.get_tile_rects():
+                data = self._vips.crop(left, top, self.size, self.size).write_to_memory()
+                yield Image.frombuffer(mode, (self.size, self.size), data, 'raw', mode, 0, 1)
+            return
+        for rect in self.get_tile_rects():
+            yield self.source.crop(rect)
+
+    def _array_roundtrips(self):
+        '''
+        Checking that tile images rebuilt from the source array with Image.fromarray 
+        (plus the palette for "P" images) keep the source mode. Not so e.g. for CMYK or YCbCr.
+        '''
+        mode = self.source.mode
+        return mode == 'P' or Image.fromarray(self._get_arr()[:1,:1]).mode == mode
             
     def write_tiles(self, target_dir='tiles', 
                     rotate=False,
                     flip=False,
-                    filename_prefix = None):
+                    filename_prefix = None,
+                    workers = None,
+                    tile_format = 'png',
+                    compress_level = 1,
+                    quality = 90,
+                    dedupe = False):
         '''
-        Writing tiles into separate .png files.
+        Writing tiles into separate .png (or .jpg) files.
         
         Syntax:
             
-            t.write_tiles(target_dir, rotate, flip, filename_prefix)
+            t.write_tiles(target_dir, rotate, flip, filename_prefix, workers, tile_format, compress_level, quality, dedupe)
             
         Parameters:
             
@@ -140,40 +423,198 @@ class Tiling():
             
             flip (bool):  in addition to original tile, write its copies flipped horizontally and vertically (by default False)
             
-            filename_prefix (str): the prefix part in a tile filename <PREFIX>_x_<LEFT>_y_<TOP>.png.
+            filename_prefix (str): the prefix part in a tile filename <PREFIX>_x_<LEFT>_y_<TOP>.<EXT>.
                                    If the source of tiling is a file, prefix is source file name by default.
                                    If the source of tiling is a PIL image, prefix is empty string by default.
 
+            workers (int): number of threads encoding tiles in parallel (by default the number of CPUs).
+                           With workers=1 tiles are written in the calling thread.
+
+            tile_format (str): "png" (lossless, by default) or "jpg" (lossy, much smaller and faster to encode).
+
+            compress_level (int): PNG zlib compression level from 0 to 9 (by default 1).
+                                  Higher levels give slightly smaller files at a much higher encoding cost.
+
+            quality (int): JPEG quality from 1 to 95 (by default 90). Ignored for PNG tiles.
+
+            dedupe (bool): encode identical tiles (e.g. uniform background) once and hard-link their files
+                           to the first one (by default False). Falls back to copying where hard links are not supported.
+                           Linked files share their contents: rewriting one of them in place changes all of them.
+
         '''
         if filename_prefix is None:
             prefix = self.source_name
         else:
             prefix = filename_prefix
-        tiles = self.get_tile_rects()
+        if workers is None:
+            workers = os.cpu_count() or 1
+        (ext, save_params) = _get_save_params(tile_format, compress_level, quality)
         if not os.path.exists(target_dir) or not os.path.isdir(target_dir):
             os.mkdir(target_dir)
-        for tile in tiles:
-            (left, top, right, bottom) = tile
+        arr = self._get_arr()
+        palette = self.source.getpalette() if self.source.mode == 'P' else None
+        jobs = []
+        for (left, top, right, bottom) in self.get_tile_rects():
             tilename = prefix+'_x_' +str(left).zfill(5)+'_y_'+str(top).zfill(5)
-            crop = self.source.crop(tile)
-            crop.save(os.path.join(target_dir, tilename+'.png'))
-            if rotate:
-                for angle in (90,180,270):
-                    copyname = tilename+'_rot_'+str(angle)
-                    copy = crop.transpose(rot_angles[angle])
-                    copy.save(os.path.join(target_dir, copyname+'.png'))
-            if flip:
-                for flip_mode in ('vert', 'hor'):
-                    copyname = tilename+'_flip_'+flip_mode
-                    copy = crop.transpose(flip_modes[flip_mode])
-                    copy.save(os.path.join(target_dir, copyname+'.png'))
-                if rotate:
-                    copy1 = copy.transpose(rot_angles[90])
-                    copy1.save(os.path.join(target_dir, copyname+'_rot_90.png'))
-                    copy1 = copy.transpose(rot_angles[270])
-                    copy1.save(os.path.join(target_dir, copyname+'_rot_270.png'))
-        tiles.close()
+            jobs.append((left, top, os.path.join(target_dir, tilename)))
+        variants = _get_variants(rotate, flip)
+        # modes that don't survive the array round trip are cropped from the source image instead
+        write = functools.partial(_write_tile, arr if self._array_roundtrips() else None, self.source,
+                                  palette, self.size, variants, ext, save_params)
+        links = []
+        written = {}
+        lock = threading.Lock()
+        def write_job(job):
+            (left, top, path) = job
+            if dedupe:
+                # hashed within the job, so hashing runs in parallel and doesn't hold back encoding
+                key = _tile_key(arr[top:top+self.size, left:left+self.size])
+                with lock:
+                    first = written.setdefault(key, path)
+                if first != path:
+                    links.append((first, path))
+                    return
+            write(*job)
+        if workers == 1:
+            for job in jobs:
+                write_job(job)
+        else:
+            # PIL releases the GIL while encoding, so threads sharing the source array encode in parallel
+            with ThreadPoolExecutor(workers) as executor:
+                for _ in executor.map(write_job, jobs):
+                    pass
+        for (src, dst) in links:
+            for suffix, flip, k in variants:
+                _link_file(src+suffix+ext, dst+suffix+ext)
+        
+    def write_tiles_sqlite(self, db_path,
+                           workers = None,
+                           tile_format = 'png',
+                           compress_level = 1,
+                           quality = 90):
+        '''
+        Writing tiles into a single SQLite database file, as encoded images in table tiles(x, y, data).
+        Avoids the filesystem overhead of one file per tile. Tiles already stored at the same (x, y) are replaced.
         
+        Syntax:
+            
+            t.write_tiles_sqlite(db_path, workers, tile_format, compress_level, quality)
+            
+        Parameters:
+            
+            db_path (str): database file name.
+
+            workers (int): number of threads encoding tiles in parallel (by default the number of CPUs).
+
+            tile_format (str): "png" (lossless, by default) or "jpg" (lossy, much smaller and faster to encode).
+
+            compress_level (int): PNG zlib compression level from 0 to 9 (by default 1).
+
+            quality (int): JPEG quality from 1 to 95 (by default 90). Ignored for PNG tiles.
+
+        '''
+        if self.source is None:
+            raise AttributeError('You should apply the tiling to an image before calling this method.')
+        if workers is None:
+            workers = os.cpu_count() or 1
+        save_params = _get_save_params(tile_format, compress_level, quality)[1]
+        palette = self.source.getpalette() if self.source.mode == 'P' else None
+        arr = self._get_arr() if self._array_roundtrips() else None
+        encode = functools.partial(_encode_tile, arr, self.source, palette, save_params)
+        rects = self.get_tile_rects_array().tolist()
+        con = sqlite3.connect(db_path)
+        try:
+            # page_size only takes effect if set before the database is created
+            con.executescript('PRAGMA page_size=8192; PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;')
+            con.execute('CREATE TABLE IF NOT EXISTS tiles(x INT, y INT, data BLOB, PRIMARY KEY(x,y))')
+            insert = 'INSERT OR REPLACE INTO tiles VALUES(?,?,?)'
+            # the next batch is submitted for encoding before the current one is inserted,
+            # so encoding keeps running while sqlite writes
+            with con, ThreadPoolExecutor(workers) as executor:
+                rows = None
+                for i in range(0, len(rects), 256):
+                    next_rows = executor.map(encode, rects[i:i+256])
+                    if rows is not None:
+                        con.executemany(insert, rows)
+                    rows = next_rows
+                if rows is not None:
+                    con.executemany(insert, rows)
+        finally:
+            con.close()
+
+    def read_tiles_sqlite(self, db_path):
+        '''
+        Yielding tiles stored in a SQLite database file by write_tiles_sqlite().
+
+        Syntax:
+            
+            img = t.assemble(t.read_tiles_sqlite(db_path))
+            
+        Yields:
+            
+            (rect, PIL image) tuple, from left to right, from top to bottom.
+        '''
+        con = sqlite3.connect(db_path)
+        try:
+            for (x, y, data) in con.execute('SELECT x, y, data FROM tiles ORDER BY y, x'):
+                yield (x, y, x+self.size, y+self.size), Image.open(io.BytesIO(data))
+        finally:
+            con.close()
+
+    def stream(self, filter_fn=None, transform_fn=None, sink_fn=None, prefetch=8):
+        '''
+        Filtering and transforming tiles as numpy arrays in a thread pool, and passing accepted tiles on 
+        in the order of get_tile_rects(). At most prefetch tiles are processed or waiting at a time, 
+        so memory use beyond the source does not grow with the image size.
+
+        Syntax:
+            
+            t.stream(filter_fn, transform_fn, sink_fn, prefetch)
+            for rect, tile in t.stream(filter_fn, transform_fn): ...
+
+        Parameters:
+
+            filter_fn (callable): filter_fn(tile) -> bool, tiles for which it returns False are skipped (by default all tiles are accepted).
+
+            transform_fn (callable): transform_fn(tile) -> array applied to accepted tiles (by default tiles are passed on as is).
+
+            sink_fn (callable): sink_fn(rect, tile) called for every accepted tile in the calling thread.
+                                If not given, stream() returns a generator of (rect, tile) tuples instead.
+
+            prefetch (int): number of threads and maximal number of tiles in flight (by default 8).
+
+            Tiles given to filter_fn and transform_fn are read-only views of the source array.
+
+        Returns:
+
+            None if sink_fn is given, else generator of (rect, tile array) tuples.
+        '''
+        if self.source is None:
+            raise AttributeError('You should apply the tiling to an image before calling this method.')
+        tiles = self._stream(filter_fn, transform_fn, prefetch)
+        if sink_fn is None:
+            return tiles
+        for rect, tile in tiles:
+            sink_fn(rect, tile)
+
+    def _stream(self, filter_fn, transform_fn, prefetch):
+        '''
+        Yielding (rect, tile) tuples of accepted tiles for stream(), keeping at most prefetch tiles in flight.
+        '''
+        process = functools.partial(_process_tile, self._get_arr(), filter_fn, transform_fn)
+        rects = self.get_tile_rects()
+        pending = deque()
+        with ThreadPoolExecutor(prefetch) as executor:
+            while True:
+                for rect in itertools.islice(rects, prefetch - len(pending)):
+                    pending.append((rect, executor.submit(process, rect)))
+                if not pending:
+                    break
+                (rect, future) = pending.popleft()
+                tile = future.result()
+                if tile is not None:
+                    yield rect, tile
+
     def filter_tiles(self, 
                  lower_threshold = 0,
                  upper_threshold = 255
@@ -190,12 +631,37 @@ class Tiling():
             (rect, PIL image) tuple
             
         '''
-        rects = self.get_tile_rects()
-        images = self.get_tile_images()
-        for rect, image in zip(rects, images):
-            mean_pix_val = np.asarray(image).mean()
-            if mean_pix_val > lower_threshold and mean_pix_val < upper_threshold:
-                yield rect,image
+        mask = self.filter_tiles_mask(lower_threshold, upper_threshold)
+        for rect in itertools.compress(self._rects_list, mask):
+            yield rect, self.source.crop(rect)
+
+    def filter_tiles_mask(self, 
+                          lower_threshold = 0,
+                          upper_threshold = 255
+                          ):
+        '''
+        Marking tiles with lower_threshold < mean pixel value < upper_threshold, all tiles at once.
+        
+        Syntax:
+            
+            mask = t.filter_tiles_mask(lower_threshold, upper_threshold)
+            rects = t.get_tile_rects_array()[mask]
+            
+        Returns:
+            
+            numpy boolean array of shape (n_tiles,), in the order of get_tile_rects().
+            
+        '''
+        if self.source is None:
+            raise AttributeError('You should apply the tiling to an image before calling this method.')
+        arr = self._get_arr()
+        area = self.size*self.size*(1 if arr.ndim == 2 else arr.shape[2])
+        if self.stride >= self.size:
+            # tiles don't overlap, so every pixel is read at most once: sum them directly
+            means = self._get_tile_sums()/area
+            return (means > lower_threshold) & (means < upper_threshold)
+        (sat, sat_rects) = self._get_sat()
+        return tile_mean_mask(sat, sat_rects, area, lower_threshold, upper_threshold)
     
     def assemble(self, tiles, mode='RGB'):
         '''
@@ -229,30 +695,33 @@ class Tiling():
             
         '''
         rects = self.get_tile_rects()
-        img = Image.new(mode, self.source.size)        
-        for tile in tiles:
-            if type(tile) is str:
-                fname = os.path.split(tile)[-1]
-                fname, ext = os.path.splitext(fname)
-                fnamesplit = fname.split('_')
-                if 'rot' in fnamesplit or 'flip' in fnamesplit:
-                    continue
-                try:
-                    x_ind = fnamesplit.index('x')
-                    y_ind = fnamesplit.index('y')
-                    x = int(fnamesplit[x_ind+1])
-                    y = int(fnamesplit[y_ind+1])
-                except Exception:
-                    raise ValueError('Filenames are expected to contain "x_<left>_y_<top>" substring.')
-                tile_img = Image.open(tile, mode=mode)
-                resp_rect = (x,y,x+self.size,y+self.size)
-                img.paste(tile_img, resp_rect)
-            elif type(tile) is tuple and len(tile) == 2:
-                tile_img = tile[1]
-                resp_rect = tile[0]
-                img.paste(tile_img, resp_rect)
-            else:
-                tile_img = tile
-                rect = next(rects)
-                img.paste(tile_img, rect)
-        return img
+        canvas = Image.new(mode, self.source.size)
+        # tile files are decoded by a thread pool (PIL releases the GIL while decoding) ahead of pasting,
+        # keeping at most `window` decoded tiles pending
+        workers = os.cpu_count() or 1
+        window = 4*workers
+        pending = deque()
+        with ThreadPoolExecutor(workers) as executor:
+            for tile in tiles:
+                if type(tile) is str:
+                    fname = os.path.split(tile)[-1]
+                    fname, ext = os.path.splitext(fname)
+                    if _COPY_RE.search(fname):
+                        continue
+                    match = _COORD_RE.search(fname)
+                    if match is None:
+                        raise ValueError('Filenames are expected to contain "x_<left>_y_<top>" substring.')
+                    x = int(match.group(1))
+                    y = int(match.group(2))
+                    pending.append((executor.submit(_load_tile, tile, mode), x, y))
+                elif type(tile) is tuple and len(tile) == 2:
+                    (left, top) = tile[0][:2]
+                    pending.append((tile[1], left, top))
+                else:
+                    (left, top) = next(rects)[:2]
+                    pending.append((tile, left, top))
+                if len(pending) > window:
+                    _paste(canvas, *pending.popleft(), mode)
+            while pending:
+                _paste(canvas, *pending.popleft(), mode)
+        return canvas